@@ -1,13 +1,80 @@
 import os
+import re
 import sys
 import argparse
 import time
 import random
-import mimetypes
+import hashlib
+import mmap
+import sqlite3
+import tempfile
+import csv
+import queue
+import threading
+import functools
+import logging
+from concurrent.futures import Future
 from pathlib import Path
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 import google.generativeai as genai
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+MODEL_NAME = 'gemini-2.0-pro-exp-02-05'
+
+MAX_RETRIES = 3
+
+# Match "- Description: ..." / "- Tags: ..." lines, tolerating case, markdown
+# emphasis and numbered list markers such as "1." or "2)"
+DESCRIPTION_RE = re.compile(r'(?im)^[ \t\-*\d.)]*description:[ \t*]*(.*\S)')
+TAGS_RE = re.compile(r'(?im)^[ \t\-*\d.)]*tags:[ \t*]*(.*\S)')
+
+# Supported video extensions and the mime types the Gemini API expects for them
+VIDEO_MIME_TYPES = {
+    '.mp4': 'video/mp4',
+    '.mpeg': 'video/mpeg',
+    '.mov': 'video/mov',
+    '.avi': 'video/avi',
+    '.flv': 'video/x-flv',
+    '.mpg': 'video/mpg',
+    '.webm': 'video/webm',
+    '.wmv': 'video/wmv',
+    '.3gp': 'video/3gpp',
+}
+
+VIDEO_EXTENSIONS = frozenset(VIDEO_MIME_TYPES)
+
+CACHE_PATH = Path.home() / '.video_tagger_cache.db'
+
+PROMPT = """
+    Given a short video description based on your observation of this video, generate:
+    1. A concise description (1 sentence, max 15 words) capturing the video's key visual and emotional elements.
+    2. A list of 2-5 tags (single words or short phrases) for filtering and context, focusing on appearance, emotion, and setting.
+
+    Example Input: "A man confidently speaking outdoors"
+    Example Output:
+    - Description: "A confident man speaking in an outdoor environment."
+    - Tags: ["man", "confident", "outdoor", "speaking"]
+
+    Provide the output in this format:
+    - Description: [your description]
+    - Tags: [tag1, tag2, tag3, ...]
+    """
+
+# Prompt part of the request, built once and shared by every call
+PROMPT_PART = {"text": PROMPT}
+
 def setup_args():
     """Setup command line arguments."""
     parser = argparse.ArgumentParser(description='Generate tags and descriptions for video files using Google Gemini API.')
@@ -15,8 +82,12 @@ def setup_args():
     parser.add_argument('-o', '--output', help='Path to output file (if not specified, prints to console)')
     parser.add_argument('-f', '--format', choices=['json', 'txt', 'csv'], default='json', help='Output format (default: json)')
     parser.add_argument('-w', '--wait', type=int, default=5, help='Initial wait time in seconds between video processing (default: 5)')
+    parser.add_argument('-c', '--concurrency', type=int, default=3, help='Number of videos to process in parallel (default: 3)')
+    parser.add_argument('-u', '--upload-concurrency', type=int, default=6, help='Number of videos to upload in parallel (default: 6)')
     parser.add_argument('-r', '--retry', action='store_true', help='Force retry processing of videos that failed previously')
     parser.add_argument('-s', '--specific', help='Process only a specific video file within a directory')
+    parser.add_argument('--no-cache', action='store_true', help='Do not reuse or store responses in the local response cache')
+    parser.add_argument('--verbose', action='store_true', help='Print debug output for every video and result')
     return parser.parse_args()
 
 def init_gemini_client():
@@ -29,16 +100,20 @@ def init_gemini_client():
         print("Please create a .env file with your GEMINI_API_KEY.")
         sys.exit(1)
     
-    genai.configure(api_key=api_key)
+    # gRPC is already the SDK's default transport, this only makes it explicit.
+    # Uploads go through a separate REST client either way
+    genai.configure(api_key=api_key, transport='grpc')
     return genai
 
-def is_valid_video_file(file_path, min_size_bytes=10):
+def is_valid_video_file(file_path, min_size_bytes=10, suffix=None):
     """
     Check if the file is a valid video file that can be processed.
     
     Args:
         file_path: Path to the video file
         min_size_bytes: Minimum file size in bytes
+        suffix: Lowercase extension already checked against VIDEO_EXTENSIONS,
+            skips the extension check when given
     
     Returns:
         bool: True if the file is valid, False otherwise
@@ -53,108 +128,268 @@ def is_valid_video_file(file_path, min_size_bytes=10):
     if file_path.stat().st_size < min_size_bytes:
         return False
     
-    # Check file extension
-    video_extensions = ['.mp4', '.mpeg', '.mov', '.avi', '.flv', '.mpg', '.webm', '.wmv', '.3gp']
-    if file_path.suffix.lower() not in video_extensions:
-        return False
+    # Check file extension. All known extensions are video types, so there
+    # is no need to also check the mime type
+    if suffix is None:
+        suffix = file_path.suffix.lower()
+    return suffix in VIDEO_EXTENSIONS
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    """
+    Hash the contents of a file without loading it into memory.
     
-    # Try to determine mime type
-    mime_type, _ = mimetypes.guess_type(str(file_path))
-    if mime_type and not mime_type.startswith('video/'):
-        return False
+    Uses BLAKE3 over a memory map of the file when the blake3 package is
+    installed, otherwise BLAKE2b over chunks read from the file.
     
-    return True
+    Args:
+        file_path: Path to the file
+        chunk_size: Number of bytes to read at a time when falling back to BLAKE2b
+        
+    Returns:
+        str: Hex digest of the file contents
+    """
+    with open(file_path, 'rb') as f:
+        if blake3:
+            # Empty files cannot be memory mapped
+            if os.fstat(f.fileno()).st_size == 0:
+                return blake3.blake3().hexdigest()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return blake3.blake3(mm).hexdigest()
+        
+        digest = hashlib.blake2b()
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
 
-def upload_video_to_file_api(client, video_path, max_retries=3, base_delay=2):
+class ResponseCache:
+    """
+    On-disk cache of model responses.
+    
+    Responses are keyed by the hash of the video contents together with the
+    model and prompt, so an unchanged video is not uploaded and analyzed
+    again on later runs. Only responses with both a description and tags
+    are stored, so malformed ones are requested again.
     """
-    Upload a video to the Gemini File API.
+    
+    def __init__(self, db_path=CACHE_PATH, model=MODEL_NAME, prompt=PROMPT):
+        self.model = model
+        self.prompt_hash = hashlib.blake2b(prompt.encode()).hexdigest()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "hash TEXT, model TEXT, prompt_hash TEXT, response TEXT, ts INTEGER, "
+                "PRIMARY KEY (hash, model, prompt_hash))"
+            )
+    
+    def lookup(self, video_path, suffix=None, refresh=False):
+        """
+        Look up the cached response for a video.
+        
+        Args:
+            video_path: Path to the video file
+            suffix: Lowercase extension if already validated
+            refresh: Only compute the digest and ignore any cached response,
+                so the video is analyzed again and its new response stored
+            
+        Returns:
+            tuple: (digest, response), where either may be None if the file
+            is not a valid video, could not be read, or no response has been
+            cached for it
+        """
+        if not is_valid_video_file(video_path, suffix=suffix):
+            return None, None
+        
+        try:
+            digest = file_digest(video_path)
+            if refresh:
+                return digest, None
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT response FROM responses WHERE hash = ? AND model = ? AND prompt_hash = ?",
+                    (digest, self.model, self.prompt_hash)
+                ).fetchone()
+        except (OSError, ValueError, sqlite3.Error) as e:
+            # Process the video without the cache rather than failing it
+            print(f"Warning: Could not check response cache for {Path(video_path).name}: {e}")
+            return None, None
+        return digest, row[0] if row else None
+    
+    def store(self, digest, response):
+        """Store the response for the video with the given digest, if it is complete."""
+        description, tags = parse_response(response)
+        if not (description and tags):
+            return
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (digest, self.model, self.prompt_hash, response, int(time.time()))
+                )
+        except sqlite3.Error as e:
+            print(f"Warning: Could not store response in cache: {e}")
+
+class EmptyResponseError(Exception):
+    """Raised when the model returns an empty response."""
+
+def print_retry(retry_state):
+    """Report a failed attempt before tenacity sleeps until the next one."""
+    print(f"Error: {retry_state.outcome.exception()}")
+    print(f"Retrying in {retry_state.next_action.sleep:.2f} seconds... "
+          f"(Attempt {retry_state.attempt_number}/{MAX_RETRIES})")
+
+# Retry API calls with exponential backoff and jitter, re-raising the last error
+api_retry = retry(
+    wait=wait_exponential_jitter(initial=2, max=60),
+    stop=stop_after_attempt(MAX_RETRIES + 1),
+    retry=retry_if_exception_type(Exception),
+    before_sleep=print_retry,
+    reraise=True
+)
+
+def video_mime_type(video_path, suffix=None):
+    """
+    Get the mime type of a video from its extension.
     
     Args:
-        client: The Gemini API client
         video_path: Path to the video file
-        max_retries: Maximum number of retry attempts
-        base_delay: Base delay in seconds between retries
+        suffix: Lowercase extension if already known
         
     Returns:
-        The file object if successful, None otherwise
+        str: The mime type, video/mp4 for unknown extensions
     """
-    retry_count = 0
-    while retry_count <= max_retries:
-        try:
-            print(f"Uploading video to File API: {video_path}")
-            file_obj = client.upload_file(path=str(video_path))
-            print(f"Upload complete. File ID: {file_obj.name}")
-            return file_obj
-        except Exception as e:
-            error_message = str(e)
-            retry_count += 1
-            
-            if retry_count <= max_retries:
-                delay = base_delay * (2 ** retry_count) + random.uniform(0, 1)
-                print(f"Error uploading file: {error_message}")
-                print(f"Retrying in {delay:.2f} seconds... (Attempt {retry_count}/{max_retries})")
-                time.sleep(delay)
-            else:
-                print(f"Failed to upload file after {max_retries} attempts: {error_message}")
-                return None
-    
-    return None
+    if suffix is None:
+        suffix = Path(video_path).suffix.lower()
+    return VIDEO_MIME_TYPES.get(suffix, 'video/mp4')
 
-def wait_for_file_processing(client, file_obj, max_wait_time=600, check_interval=10):
+@api_retry
+def upload_video_to_file_api(client, video_path, mime_type=None):
     """
-    Wait for a file to finish processing.
+    Upload a video to the Gemini File API, retrying on errors.
     
     Args:
         client: The Gemini API client
-        file_obj: The file object
-        max_wait_time: Maximum time to wait in seconds
-        check_interval: Interval between checks in seconds
+        video_path: Path to the video file
+        mime_type: Mime type of the video
         
     Returns:
-        The updated file object if processing is complete, None if failed or timed out
+        The file object
+        
+    Raises:
+        Exception: The last error if all attempts failed
     """
-    print(f"Waiting for video processing to complete...")
-    start_time = time.time()
+    print(f"Uploading video to File API: {video_path}")
+    file_obj = client.upload_file(path=str(video_path), mime_type=mime_type)
+    log.debug("Upload complete. File ID: %s", file_obj.name)
+    return file_obj
+
+class FilePoller:
+    """
+    Single background loop that waits for uploaded files to finish processing.
     
-    while True:
-        # Check if we've waited too long
-        elapsed_time = time.time() - start_time
-        if elapsed_time > max_wait_time:
-            print(f"Timed out after waiting {elapsed_time:.1f} seconds for file processing")
-            return None
+    Files are registered with register() and get a Future back. One thread
+    checks the state of every registered file once per interval, so the wait
+    is shared by all files in flight instead of each file sleeping on its own.
+    The thread is started on demand and exits once nothing is left to check.
+    """
+    
+    def __init__(self, check_interval=10):
+        self.check_interval = check_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def register(self, client, file_obj, max_wait_time=600):
+        """
+        Start tracking a file.
         
-        # Get the latest file status
+        Args:
+            client: The Gemini API client
+            file_obj: The file object returned by the upload
+            max_wait_time: Maximum time to wait in seconds
+            
+        Returns:
+            A Future resolving to the updated file object once processing is
+            complete, or to None if processing failed or timed out
+        """
+        future = Future()
+        with self._lock:
+            self._pending[file_obj.name] = (client, future, time.time(), max_wait_time)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return future
+    
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                pending = list(self._pending.items())
+            
+            for name, (client, future, start_time, max_wait_time) in pending:
+                result = self._check(client, name, start_time, max_wait_time)
+                if result is not False:
+                    with self._lock:
+                        del self._pending[name]
+                    future.set_result(result)
+            
+            time.sleep(self.check_interval)
+    
+    def _check(self, client, name, start_time, max_wait_time):
+        """Check a file once. Returns False while it is still processing."""
+        elapsed_time = time.time() - start_time
         try:
-            updated_file = client.get_file(file_obj.name)
+            updated_file = client.get_file(name)
             
             if updated_file.state.name == "ACTIVE":
-                print(f"Video processing complete after {elapsed_time:.1f} seconds")
+                print(f"Processing of {name} complete after {elapsed_time:.1f} seconds")
                 return updated_file
             elif updated_file.state.name == "FAILED":
-                print(f"Video processing failed with state: {updated_file.state.name}")
+                print(f"Processing of {name} failed with state: {updated_file.state.name}")
                 return None
-            else:
-                # Still processing
-                print(f"Still processing... ({elapsed_time:.1f}s elapsed)", end="\r")
-                time.sleep(check_interval)
+            elif elapsed_time > max_wait_time:
+                print(f"Timed out after waiting {elapsed_time:.1f} seconds for processing of {name}")
+                return None
+            return False
         except Exception as e:
-            print(f"Error checking file status: {e}")
+            print(f"Error checking status of {name}: {e}")
             return None
 
-def analyze_video(client, video_path, max_retries=3):
+file_poller = FilePoller()
+
+def wait_for_file_processing(client, file_obj, max_wait_time=600):
     """
-    Analyze the video and generate tags and description using the File API.
+    Wait for a file to finish processing.
     
-    This function uploads the video to the Gemini File API and processes the response.
+    Args:
+        client: The Gemini API client
+        file_obj: The file object
+        max_wait_time: Maximum time to wait in seconds
+        
+    Returns:
+        The updated file object if processing is complete, None if failed or timed out
+    """
+    print(f"Waiting for video processing to complete...")
+    return file_poller.register(client, file_obj, max_wait_time).result()
+
+def upload_video(client, video_path, suffix=None):
+    """
+    Validate a video and upload it to the Gemini File API.
     
     Args:
         client: The Gemini API client
         video_path: Path to the video file
-        max_retries: Maximum number of retry attempts
+        suffix: Lowercase extension if already validated
+        
+    Returns:
+        The file object if successful, otherwise an error result for the video
     """
     video_path = Path(video_path)
     
-    if not is_valid_video_file(video_path):
+    if not is_valid_video_file(video_path, suffix=suffix):
         print(f"Error: Invalid or unsupported video file: {video_path}")
         return {
             "filename": video_path.name,
@@ -165,14 +400,123 @@ def analyze_video(client, video_path, max_retries=3):
     file_size_mb = video_path.stat().st_size / (1024 * 1024)
     print(f"Processing video: {video_path} ({file_size_mb:.2f} MB)")
     
-    # Step 1: Upload the video to the File API
-    file_obj = upload_video_to_file_api(client, video_path)
-    if not file_obj:
+    try:
+        file_obj = upload_video_to_file_api(client, video_path, video_mime_type(video_path, suffix))
+    except Exception as e:
+        print(f"Failed to upload file after {MAX_RETRIES} retries: {e}")
         return {
             "filename": video_path.name,
             "error": "Failed to upload video to File API"
         }
     
+    return file_obj
+
+@functools.lru_cache(maxsize=4)
+def get_model(client, model_name):
+    """Return a GenerativeModel for the given name, reusing it across calls and threads."""
+    return client.GenerativeModel(model_name)
+
+@api_retry
+def generate_content_once(client, processed_file, mime_type):
+    """
+    Ask the model to describe a processed video, retrying on errors.
+    
+    Args:
+        client: The Gemini API client
+        processed_file: The ACTIVE file object returned by the File API
+        mime_type: Mime type of the video
+        
+    Returns:
+        str: The stripped response text
+        
+    Raises:
+        EmptyResponseError: If the model returned no text
+        Exception: The last error if all attempts failed
+    """
+    video_part = {"file_data": {"file_uri": processed_file.uri, "mime_type": mime_type}}
+    
+    model = get_model(client, MODEL_NAME)
+    response = model.generate_content(contents=[{"parts": [video_part, PROMPT_PART]}])
+    
+    if not response or not response.text or response.text.strip() == "":
+        raise EmptyResponseError("Empty response received")
+    return response.text.strip()
+
+def generate_description(client, processed_file, video_path, suffix=None):
+    """
+    Generate tags and a description for a video that finished processing.
+    
+    Args:
+        client: The Gemini API client
+        processed_file: The ACTIVE file object returned by the File API
+        video_path: Path to the video file
+        suffix: Lowercase extension if already known
+        
+    Returns:
+        The result for the video
+    """
+    video_path = Path(video_path)
+    try:
+        text = generate_content_once(client, processed_file, video_mime_type(video_path, suffix))
+    except EmptyResponseError:
+        print(f"Warning: Empty response received for {video_path.name}")
+        return {
+            "filename": video_path.name,
+            "error": "Empty response received after multiple attempts"
+        }
+    except Exception as e:
+        print(f"Failed to generate content after {MAX_RETRIES} retries: {e}")
+        return {
+            "filename": video_path.name,
+            "error": str(e)
+        }
+    
+    # Check if the response contains expected format
+    if not ("Description:" in text and "Tags:" in text):
+        print(f"Warning: Response format incorrect for {video_path.name}")
+        log.debug("Response was: %.100s...", text)
+        
+        # Try to fix common formatting issues
+        description, tags = parse_response(text)
+        if description and tags:
+            log.debug("Successfully reformatted response for %s", video_path.name)
+            text = f"- Description: {description}\n- Tags: {tags}"
+    
+    print(f"Successfully generated description and tags for {video_path.name}")
+    return {
+        "filename": video_path.name,
+        "response": text
+    }
+
+def analyze_video(client, video_path, response_cache=None, force_retry=False):
+    """
+    Analyze the video and generate tags and description using the File API.
+    
+    This function uploads the video to the Gemini File API and processes the response.
+    
+    Args:
+        client: The Gemini API client
+        video_path: Path to the video file
+        response_cache: Optional ResponseCache to reuse and store responses
+        force_retry: Analyze the video again instead of reusing a cached response
+    """
+    video_path = Path(video_path)
+    
+    digest = None
+    if response_cache:
+        digest, response = response_cache.lookup(video_path, refresh=force_retry)
+        if response:
+            log.debug("Using cached response for %s", video_path.name)
+            return {
+                "filename": video_path.name,
+                "response": response
+            }
+    
+    # Step 1: Upload the video to the File API
+    file_obj = upload_video(client, video_path)
+    if isinstance(file_obj, dict):
+        return file_obj
+    
     # Step 2: Wait for processing to complete
     processed_file = wait_for_file_processing(client, file_obj)
     if not processed_file:
@@ -182,275 +526,521 @@ def analyze_video(client, video_path, max_retries=3):
         }
     
     # Step 3: Generate content with the processed file
-    prompt = """
-    Given a short video description based on your observation of this video, generate:
-    1. A concise description (1 sentence, max 15 words) capturing the video's key visual and emotional elements.
-    2. A list of 2-5 tags (single words or short phrases) for filtering and context, focusing on appearance, emotion, and setting.
+    result = generate_description(client, processed_file, video_path)
+    if digest and "response" in result:
+        response_cache.store(digest, result["response"])
+    return result
 
-    Example Input: "A man confidently speaking outdoors"
-    Example Output:
-    - Description: "A confident man speaking in an outdoor environment."
-    - Tags: ["man", "confident", "outdoor", "speaking"]
+class RateLimiter:
+    """
+    Token bucket that bounds how often generate requests are sent.
+    
+    A single token is taken on every acquire() and handed back by a timer
+    after the wait time, so requests are spaced out without blocking the
+    uploads and processing of other videos.
+    """
+    
+    def __init__(self, wait_time):
+        self.wait_time = wait_time
+        self._tokens = threading.Semaphore(1)
+    
+    def acquire(self):
+        self._tokens.acquire()
+        delay = self.wait_time + random.uniform(1, 3)  # Random delay with the specified base time
+        timer = threading.Timer(delay, self._tokens.release)
+        timer.daemon = True
+        timer.start()
 
-    Provide the output in this format:
-    - Description: [your description]
-    - Tags: [tag1, tag2, tag3, ...]
+def run_pipeline(client, video_files, wait_time=5, concurrency=3, max_wait_time=600, response_cache=None,
+                 upload_concurrency=6, checkpoint=None, force_retry=False):
+    """
+    Process videos through an upload -> poll -> generate pipeline.
+    
+    Uploader and generator threads hand work to each other through the
+    shared file poller and a queue, so while one video is being
+    processed by Google's servers the next ones are uploading and earlier
+    ones are generating.
+    
+    Args:
+        client: The Gemini API client
+        video_files: List of (path, suffix) pairs, where suffix is the lowercase
+            extension already checked against VIDEO_EXTENSIONS
+        wait_time: Base wait time in seconds between generate requests
+        concurrency: Number of generation threads
+        max_wait_time: Maximum time to wait in seconds for a file to process
+        response_cache: Optional ResponseCache to reuse and store responses
+        upload_concurrency: Number of upload threads. Uploads are limited by
+            bandwidth rather than the API, so several streams run at once
+        checkpoint: Optional CsvCheckpoint each result is written to as it completes
+        force_retry: Analyze the videos again instead of reusing cached responses
+        
+    Returns:
+        List of results, in completion order
     """
+    concurrency = max(1, concurrency)
+    upload_concurrency = max(1, upload_concurrency)
+    upload_queue = queue.Queue()
+    # Unbounded so the poller's done callbacks never block, in_flight bounds it instead
+    generate_queue = queue.Queue()
+    result_queue = queue.Queue()
+    limiter = RateLimiter(wait_time)
+    # Bounds the number of files uploaded but not yet picked up by a generator
+    in_flight = threading.Semaphore(max(concurrency * 2, upload_concurrency))
+    
+    # Every video must produce exactly one result, since counting results is
+    # what ends the run, so unexpected errors become error results
+    def error_result(file_path, e):
+        print(f"Error processing {file_path.name}: {e}")
+        return {"filename": file_path.name, "error": str(e)}
     
-    retry_count = 0
-    while retry_count <= max_retries:
+    # Runs on the shared poller thread, so it must not block
+    def on_processed(file_path, suffix, digest, future):
         try:
-            # Configure the model
-            model = client.GenerativeModel('gemini-2.0-pro-exp-02-05')
-            
-            # Create content parts using the file URI
-            response = model.generate_content(
-                contents=[
-                    {
-                        "parts": [
-                            {"file_data": {"file_uri": processed_file.uri, "mime_type": "video/mp4"}},
-                            {"text": prompt}
-                        ]
-                    }
-                ]
-            )
-            
-            if not response or not response.text or response.text.strip() == "":
-                print(f"Warning: Empty response received for {video_path.name}")
-                retry_count += 1
-                if retry_count <= max_retries:
-                    delay = 2 * (2 ** retry_count) + random.uniform(0, 1)
-                    print(f"Retrying in {delay:.2f} seconds... (Attempt {retry_count}/{max_retries})")
-                    time.sleep(delay)
-                    continue
-                else:
-                    return {
-                        "filename": video_path.name,
-                        "error": "Empty response received after multiple attempts"
-                    }
-            
-            # Check if the response contains expected format
-            text = response.text.strip()
-            if not ("Description:" in text and "Tags:" in text):
-                print(f"Warning: Response format incorrect for {video_path.name}")
-                print(f"Response was: {text[:100]}...")
-                
-                # Try to fix common formatting issues
-                if "description" in text.lower() and "tags" in text.lower():
-                    # Try to reformat the response
-                    lines = text.split('\n')
-                    formatted_text = ""
-                    for line in lines:
-                        line = line.strip()
-                        if line.lower().startswith("description:") or "description:" in line.lower():
-                            formatted_text += "- Description:" + line.split("description:", 1)[1].strip() + "\n"
-                        elif line.lower().startswith("tags:") or "tags:" in line.lower():
-                            formatted_text += "- Tags:" + line.split("tags:", 1)[1].strip()
-                    
-                    if formatted_text:
-                        print(f"Successfully reformatted response for {video_path.name}")
-                        text = formatted_text
-            
-            print(f"Successfully generated description and tags for {video_path.name}")
-            return {
-                "filename": video_path.name,
-                "response": text
-            }
+            processed_file = future.result()
+            if processed_file:
+                # The generator releases the slot once it picks the file up
+                generate_queue.put((file_path, suffix, digest, processed_file))
+                return
+            result_queue.put({
+                "filename": file_path.name,
+                "error": "Video processing failed or timed out"
+            })
         except Exception as e:
-            error_message = str(e)
-            retry_count += 1
-            
-            if retry_count <= max_retries:
-                delay = 2 * (2 ** retry_count) + random.uniform(0, 1)
-                print(f"Error generating content: {error_message}")
-                print(f"Retrying in {delay:.2f} seconds... (Attempt {retry_count}/{max_retries})")
-                time.sleep(delay)
-            else:
-                print(f"Failed to generate content after {max_retries} attempts: {error_message}")
-                return {
-                    "filename": video_path.name,
-                    "error": error_message
-                }
+            result_queue.put(error_result(file_path, e))
+        in_flight.release()
     
-    return {
-        "filename": video_path.name,
-        "error": "Maximum retry attempts exceeded"
-    }
+    def upload(file_path, suffix):
+        digest = None
+        if response_cache:
+            digest, response = response_cache.lookup(file_path, suffix, refresh=force_retry)
+            if response:
+                log.debug("Using cached response for %s", file_path.name)
+                result_queue.put({"filename": file_path.name, "response": response})
+                return
+        
+        in_flight.acquire()
+        try:
+            file_obj = upload_video(client, file_path, suffix)
+            if isinstance(file_obj, dict):
+                result_queue.put(file_obj)
+                in_flight.release()
+                return
+            future = file_poller.register(client, file_obj, max_wait_time)
+        except Exception:
+            in_flight.release()
+            raise
+        future.add_done_callback(
+            lambda f, file_path=file_path, suffix=suffix, digest=digest: on_processed(file_path, suffix, digest, f))
+    
+    def uploader():
+        while True:
+            item = upload_queue.get()
+            if item is None:
+                return
+            file_path, suffix = item
+            try:
+                upload(file_path, suffix)
+            except Exception as e:
+                result_queue.put(error_result(file_path, e))
+    
+    def generator():
+        while True:
+            item = generate_queue.get()
+            if item is None:
+                return
+            in_flight.release()
+            file_path, suffix, digest, processed_file = item
+            try:
+                # Only generation counts against the API quota, uploads are not limited
+                limiter.acquire()
+                result = generate_description(client, processed_file, file_path, suffix=suffix)
+                if digest and "response" in result:
+                    response_cache.store(digest, result["response"])
+            except Exception as e:
+                result = error_result(file_path, e)
+            result_queue.put(result)
+    
+    threads = [threading.Thread(target=uploader, daemon=True) for _ in range(upload_concurrency)]
+    threads.extend(threading.Thread(target=generator, daemon=True) for _ in range(concurrency))
+    for thread in threads:
+        thread.start()
+    
+    for file_path, suffix in video_files:
+        upload_queue.put((Path(file_path), suffix))
+    for _ in range(upload_concurrency):
+        upload_queue.put(None)
+    
+    # Every video yields exactly one result, either from a failed stage or a generator
+    results = []
+    for _ in video_files:
+        result = result_queue.get()
+        if checkpoint:
+            checkpoint.write(result)
+        results.append(result)
+    
+    for _ in range(concurrency):
+        generate_queue.put(None)
+    for thread in threads:
+        thread.join()
+    
+    return results
 
-def process_videos(client, video_path, wait_time=5, force_retry=False, specific_file=None):
-    """Process single video or directory of videos."""
+def walk_video_files(root):
+    """
+    Recursively find video files below a directory.
+    
+    Uses os.scandir so the extension is checked on the raw file name and no
+    Path object is created for files that are not videos.
+    
+    Args:
+        root: Directory to search
+        
+    Yields:
+        tuple: (os.DirEntry, lowercase extension) for each file with a video extension
+    """
+    try:
+        entries = os.scandir(root)
+    except OSError:
+        return
+    
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_video_files(entry.path)
+            elif entry.is_file():
+                name = entry.name
+                dot = name.rfind('.')
+                if dot < 0:
+                    continue
+                # Most names are already lowercase, only lowercase on a miss
+                suffix = name[dot:]
+                if suffix not in VIDEO_EXTENSIONS:
+                    suffix = suffix.lower()
+                    if suffix not in VIDEO_EXTENSIONS:
+                        continue
+                yield entry, suffix
+
+def process_videos(client, video_path, wait_time=5, force_retry=False, specific_file=None, concurrency=3, response_cache=None,
+                   upload_concurrency=6, checkpoint=None):
+    """
+    Process single video or directory of videos.
+    
+    Unless force_retry is set, videos that already have a description and
+    tags are skipped and their previous results returned along with the new
+    ones. These come from the checkpoint if given, otherwise from
+    results.csv for directories. New results are also written to the
+    checkpoint, if given, as they complete.
+    """
     path = Path(video_path)
     results = []
+    previous = {}
     
     if path.is_file():
         # Process single video file
-        result = analyze_video(client, path)
-        if result:
-            results.append(result)
+        if checkpoint and not force_retry and path.name in checkpoint.previous:
+            print(f"Skipping already processed video: {path.name}")
+            previous = {path.name: checkpoint.previous[path.name]}
+        else:
+            if checkpoint:
+                checkpoint.start()
+            result = analyze_video(client, path, response_cache=response_cache, force_retry=force_retry)
+            if result:
+                if checkpoint:
+                    checkpoint.write(result)
+                results.append(result)
     elif path.is_dir():
         # Process all video files in directory
-        video_extensions = ['.mp4', '.mpeg', '.mov', '.avi', '.flv', '.mpg', '.webm', '.wmv', '.3gp']
         video_files = []
         
         # First collect all video files
-        for file_path in path.glob('**/*'):
-            if file_path.suffix.lower() in video_extensions:
-                # If specific file is specified, only include that file
-                if specific_file and file_path.name != specific_file:
-                    continue
-                video_files.append(file_path)
+        for entry, suffix in walk_video_files(path):
+            # If specific file is specified, only include that file
+            if specific_file and entry.name != specific_file:
+                continue
+            video_files.append((Path(entry.path), suffix))
         
         print(f"Found {len(video_files)} video files to process.")
         
         # Check for previous results if not forcing retry
-        previous_results = []
-        previous_processed = set()
+        if not force_retry:
+            if checkpoint:
+                previous = checkpoint.previous
+            else:
+                try:
+                    previous = processed_results(read_results_csv("results.csv"))
+                except Exception as e:
+                    print(f"Error reading previous results: {e}")
+            
+            # Remove already processed files from the list
+            if previous:
+                print(f"Loaded {len(previous)} previous results")
+                video_files = [(f, suffix) for f, suffix in video_files if f.name not in previous]
+                print(f"After filtering, {len(video_files)} videos remain to be processed.")
         
-        if not force_retry and Path("results.csv").exists():
-            try:
-                import csv
-                print("Found previous results.csv file. Checking for already processed videos...")
-                with open("results.csv", "r") as f:
-                    reader = csv.reader(f)
-                    next(reader)  # Skip header
-                    for row in reader:
-                        if len(row) >= 3 and row[0]:  # Check if filename exists
-                            filename = row[0]
-                            description = row[1]
-                            tags = row[2]
-                            
-                            # Skip videos with empty results unless force_retry is True
-                            if description and tags:
-                                previous_processed.add(filename)
-                                previous_results.append({
-                                    "filename": filename,
-                                    "response": f"- Description: {description}\n- Tags: {tags}"
-                                })
-                                print(f"Skipping already processed video: {filename}")
-                
-                # Remove already processed files from the list unless force_retry is True
-                if previous_processed:
-                    video_files = [f for f in video_files if f.name not in previous_processed]
-                    print(f"After filtering, {len(video_files)} videos remain to be processed.")
-            except Exception as e:
-                print(f"Error reading previous results: {e}")
+        if checkpoint:
+            checkpoint.start()
         
-        # Process each video with a delay between requests to avoid rate limiting
-        for i, file_path in enumerate(video_files):
-            result = analyze_video(client, file_path)
-            if result:
-                results.append(result)
-                
-            # Add a delay between videos if not the last file
-            if i < len(video_files) - 1:
-                delay = wait_time + random.uniform(1, 3)  # Random delay with the specified base time
-                print(f"Waiting {delay:.2f} seconds before processing the next video...")
-                time.sleep(delay)
-        
-        # Add previously processed results to the new results
-        results.extend(previous_results)
+        # Overlap uploading, server-side processing and generation across videos
+        results.extend(run_pipeline(client, video_files, wait_time, concurrency,
+                                    response_cache=response_cache,
+                                    upload_concurrency=upload_concurrency, checkpoint=checkpoint,
+                                    force_retry=force_retry))
     else:
         print(f"Error: Path not found: {video_path}")
     
+    # Add previously processed results to the new results
+    results.extend({
+        "filename": filename,
+        "response": f"- Description: {description}\n- Tags: {tags}"
+    } for filename, (description, tags) in previous.items())
+    
     return results
 
-def format_output(results, format_type='json'):
-    """Format the results based on the specified format."""
+def parse_response(text):
+    """
+    Extract the description and tags from a model response.
+    
+    Args:
+        text: The response text
+        
+    Returns:
+        tuple: (description, tags), empty strings for anything not found
+    """
+    description = DESCRIPTION_RE.search(text)
+    tags = TAGS_RE.search(text)
+    return (description.group(1) if description else '',
+            tags.group(1) if tags else '')
+
+CSV_HEADER = ['Filename', 'Description', 'Tags']
+
+def csv_row(result):
+    """Convert a result to a [filename, description, tags] CSV row."""
+    if 'error' in result:
+        # For errors, include the error message in the description column
+        log.debug("Writing error for %s: %s", result['filename'], result['error'])
+        return [result['filename'], f"ERROR: {result['error']}", ""]
+    
+    # Parse the response to extract description and tags
+    description, tags = parse_response(result['response'])
+    
+    if not description and not tags:
+        print(f"Warning: Could not find description or tags in response for {result['filename']}")
+        log.debug("Response content: %.100s...", result['response'])
+    
+    return [result['filename'], description, tags]
+
+def read_results_csv(results_path):
+    """
+    Read the rows of a results CSV written by an earlier run.
+    
+    Args:
+        results_path: Path to the CSV file
+        
+    Returns:
+        list: The rows without the header, empty if the file does not exist
+    """
+    if not Path(results_path).exists():
+        return []
+    with open(results_path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)  # Skip header
+        return list(reader)
+
+def is_processed_row(row):
+    """Check if a results CSV row holds a description and tags rather than an error."""
+    # Videos with empty results are not considered processed
+    return len(row) >= 3 and bool(row[0] and row[1] and row[2])
+
+def processed_results(rows):
+    """Map filename -> (description, tags) for the processed rows of a results CSV."""
+    return {row[0]: (row[1], row[2]) for row in rows if is_processed_row(row)}
+
+class CsvCheckpoint:
+    """
+    Append results to a CSV file as soon as they complete.
+    
+    Each row is flushed when written and the file is synced to disk every
+    sync_every rows, so an interrupted run keeps everything finished so far
+    and can be resumed by running it again. Older rows of videos that got a
+    new row are only dropped by close(), once the new rows are on disk, so
+    every video keeps a single row without losing any in between.
+    """
+    
+    def __init__(self, output_path, sync_every=50):
+        self.output_path = output_path
+        self.sync_every = sync_every
+        self._count = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._writer = None
+        
+        try:
+            rows = read_results_csv(output_path)
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            print(f"Error reading previous results: {e}")
+            rows = []
+        
+        # Results of videos already processed into this file
+        self.previous = processed_results(rows)
+    
+    def start(self):
+        """Open the file for appending results."""
+        path = Path(self.output_path)
+        is_empty = not path.exists() or path.stat().st_size == 0
+        
+        ends_with_newline = True
+        if not is_empty:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                ends_with_newline = f.read(1) == b'\n'
+        
+        self._file = open(path, 'a', encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file)
+        if is_empty:
+            self._writer.writerow(CSV_HEADER)
+        elif not ends_with_newline:
+            # Don't join the first new row onto an unterminated last line
+            self._file.write('\r\n')
+    
+    def _compact(self):
+        """Rewrite the file keeping only the newest row of each video, if any has several."""
+        try:
+            rows = read_results_csv(self.output_path)
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            # Leave a file we cannot parse as it is
+            print(f"Error reading results to remove replaced rows: {e}")
+            return
+        
+        latest = {}
+        for row in rows:
+            if row:
+                latest[row[0]] = row[:3]
+        if len(latest) == len(rows):
+            return
+        
+        path = Path(self.output_path)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', dir=path.parent or '.',
+                                         prefix=path.name, suffix='.tmp', delete=False) as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADER)
+            writer.writerows(latest.values())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, path)
+    
+    def write(self, result):
+        """Append the row for a result."""
+        row = csv_row(result)
+        with self._lock:
+            self._writer.writerow(row)
+            self._file.flush()
+            self._count += 1
+            if self._count % self.sync_every == 0:
+                os.fsync(self._file.fileno())
+    
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+        
+        # Every new row is on disk now, so the rows they replace can go
+        self._compact()
+
+def write_output(results, format_type, f):
+    """Write the results in the specified format to an open text file."""
     if format_type == 'json':
-        import json
-        return json.dumps(results, indent=2)
+        if orjson:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2).decode())
+        else:
+            import json
+            json.dump(results, f, indent=2, ensure_ascii=False)
     elif format_type == 'csv':
-        import csv
-        from io import StringIO
-        
-        output = StringIO()
-        writer = csv.writer(output)
+        writer = csv.writer(f)
         
         # Write header
-        writer.writerow(['Filename', 'Description', 'Tags'])
+        writer.writerow(CSV_HEADER)
         
         # Write data rows
-        for result in results:
-            if 'error' in result:
-                # For errors, include the error message in the description column
-                writer.writerow([result['filename'], f"ERROR: {result['error']}", ""])
-                print(f"Note: Writing error for {result['filename']}: {result['error']}")
-            else:
-                # Parse the response to extract description and tags
-                response_lines = result['response'].strip().split('\n')
-                description = ''
-                tags = ''
-                
-                # Debug output
-                print(f"Processing CSV output for {result['filename']}")
-                print(f"Response has {len(response_lines)} lines")
-                
-                for line in response_lines:
-                    line = line.strip()
-                    if line.startswith('- Description:'):
-                        description = line.replace('- Description:', '').strip()
-                        print(f"Found description: {description[:30]}...")
-                    elif line.startswith('- Tags:'):
-                        tags = line.replace('- Tags:', '').strip()
-                        print(f"Found tags: {tags[:30]}...")
-                
-                if not description and not tags:
-                    print(f"Warning: Could not find description or tags in response for {result['filename']}")
-                    print(f"Response content: {result['response'][:100]}...")
-                    # Try a less strict parsing approach
-                    for line in response_lines:
-                        line = line.strip().lower()
-                        if 'description:' in line:
-                            parts = line.split('description:', 1)
-                            if len(parts) > 1:
-                                description = parts[1].strip()
-                                print(f"Found description with alternate parsing: {description[:30]}...")
-                        elif 'tags:' in line:
-                            parts = line.split('tags:', 1)
-                            if len(parts) > 1:
-                                tags = parts[1].strip()
-                                print(f"Found tags with alternate parsing: {tags[:30]}...")
-                
-                writer.writerow([result['filename'], description, tags])
-        
-        return output.getvalue()
+        writer.writerows(csv_row(result) for result in results)
     else:  # txt format
-        output = ""
         for result in results:
-            output += f"File: {result['filename']}\n"
+            f.write(f"File: {result['filename']}\n")
             if 'error' in result:
-                output += f"Error: {result['error']}\n"
+                f.write(f"Error: {result['error']}\n")
             else:
-                output += f"{result['response']}\n"
-            output += "-" * 80 + "\n"
-        return output
-
-def save_output(content, output_path):
-    """Save the output to a file."""
-    with open(output_path, 'w') as f:
-        f.write(content)
+                f.write(f"{result['response']}\n")
+            f.write("-" * 80 + "\n")
+
+def format_output(results, format_type='json'):
+    """Format the results based on the specified format."""
+    from io import StringIO
+    
+    output = StringIO()
+    write_output(results, format_type, output)
+    return output.getvalue()
+
+def save_output(results, format_type, output_path):
+    """Save the results to a file, writing them directly instead of formatting in memory first."""
+    if format_type == 'json' and orjson:
+        # orjson produces UTF-8 bytes, write them without decoding
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    else:
+        newline = '' if format_type == 'csv' else None
+        with open(output_path, 'w', encoding='utf-8', newline=newline) as f:
+            write_output(results, format_type, f)
     print(f"Results saved to {output_path}")
 
 def main():
     args = setup_args()
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    # Only this script's debug output, not that of the libraries it uses
+    log.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
     client = init_gemini_client()
     
-    results = process_videos(client, args.video, args.wait, args.retry, args.specific)
+    response_cache = None
+    if not args.no_cache:
+        try:
+            response_cache = ResponseCache()
+        except sqlite3.Error as e:
+            print(f"Warning: Could not open response cache, continuing without it: {e}")
+    
+    output_path = args.output
+    if output_path and not Path(output_path).suffix and args.format:
+        # If output is specified but no extension, add the format as extension
+        output_path = f"{output_path}.{args.format}"
+    
+    # CSV output is appended to as each video completes, so an interrupted
+    # run can be resumed from the same file
+    if output_path and args.format == 'csv':
+        checkpoint = CsvCheckpoint(output_path)
+        try:
+            results = process_videos(client, args.video, args.wait, args.retry, args.specific, args.concurrency,
+                                     response_cache, args.upload_concurrency, checkpoint)
+        finally:
+            checkpoint.close()
+        
+        if results:
+            print(f"Results saved to {output_path}")
+        else:
+            print("No results to display.")
+        return
+    
+    results = process_videos(client, args.video, args.wait, args.retry, args.specific, args.concurrency,
+                             response_cache, args.upload_concurrency)
     
     if not results:
         print("No results to display.")
         return
     
-    formatted_output = format_output(results, args.format)
-    
-    if args.output:
-        # If output is specified but no extension, add the format as extension
-        output_path = args.output
-        if not Path(output_path).suffix and args.format:
-            output_path = f"{output_path}.{args.format}"
-        save_output(formatted_output, output_path)
+    if output_path:
+        save_output(results, args.format, output_path)
     else:
-        print(formatted_output)
+        print(format_output(results, args.format))
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file